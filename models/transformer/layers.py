@@ -393,7 +393,9 @@ class DecoderState(object):
                 if v is not None:
                     if isinstance(v, dict):
                         _recursive_map(v)
-                    else:
+                    elif torch.is_tensor(v):
+                        # non-tensor entries (e.g. cached KV lengths) carry no
+                        # batch dimension to remap
                         struct[k] = fn(v, batch_dim)
         if self.cache is not None:
             _recursive_map(self.cache)
\ No newline at end of file
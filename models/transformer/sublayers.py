@@ -2,13 +2,90 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 
+# Allow TF32 tensor-core math for FP32 matmuls and convolutions (Ampere+ GPUs)
+try:
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+except AttributeError:
+    # torch < 1.7 has no TF32 switches
+    pass
+
+# torch.nn.functional.scaled_dot_product_attention dispatches to fused
+# (FlashAttention / memory-efficient) kernels on supported hardware and avoids
+# materializing the full [batch, heads, q_len, k_len] attention matrix in HBM.
+_HAS_SDPA = hasattr(nn.functional, 'scaled_dot_product_attention')
+
+# Optional direct FlashAttention-2 backend, for long-context training where
+# the SDPA dispatcher may fall back to the math kernel
+try:
+    from flash_attn import flash_attn_func as _flash_attn_func
+except ImportError:
+    _flash_attn_func = None
+
+# Initial capacity (in decode steps) of the pre-allocated KV cache buffers;
+# grown by doubling when exhausted
+_KV_CACHE_INIT_CAPACITY = 64
+
+
+def _split_heads(x, num_heads):
+    # type: (Tensor, int) -> Tensor
+    """
+    Split x such to add an extra num_heads dimension
+    Input:
+        x: a Tensor with shape [batch_size, seq_length, depth]
+    Returns:
+        A Tensor with shape [batch_size, num_heads, seq_length, depth/num_heads]
+    """
+    if len(x.shape) != 3:
+        raise ValueError("x must have rank 3")
+    shape = x.shape
+    return x.view(shape[0], shape[1], num_heads, shape[2] // num_heads).permute(0, 2, 1, 3)
+
+
+def _merge_heads(x, num_heads):
+    # type: (Tensor, int) -> Tensor
+    """
+    Merge the extra num_heads into the last dimension
+    Input:
+        x: a Tensor with shape [batch_size, num_heads, seq_length, depth/num_heads]
+    Returns:
+        A Tensor with shape [batch_size, seq_length, depth]
+    """
+    if len(x.shape) != 4:
+        raise ValueError("x must have rank 4")
+    shape = x.shape
+    return x.permute(0, 2, 1, 3).contiguous().view(shape[0], shape[2], shape[3] * num_heads)
+
+
+try:
+    # Scripted versions skip Python dispatch for the view/permute chains,
+    # which add up over layers x decode steps
+    _split_heads = torch.jit.script(_split_heads)
+    _merge_heads = torch.jit.script(_merge_heads)
+except RuntimeError:
+    pass
+
+
+def _autocast(device_type, dtype):
+    """
+    Mixed-precision context for the given device type; no-op when dtype is None
+    """
+    if dtype is None:
+        return contextlib.suppress()
+    return torch.autocast(device_type=device_type, dtype=dtype)
+
 
 class MultiHeadAttention(nn.Module):
     def __init__(self, input_depth, total_key_depth, total_value_depth, output_depth,
-                 num_heads, bias_mask=None, dropout=0.0, attention_type=None):
+                 num_heads, bias_mask=None, dropout=0.0, attention_type=None,
+                 autocast_dtype=None, quantize_kv_cache=False, use_flash_attn=False,
+                 compile_forward=False, num_kv_heads=None):
         """
         Parameters:
             input_depth: Size of last dimension of input
@@ -18,6 +95,18 @@ class MultiHeadAttention(nn.Module):
             num_heads: Number of attention heads
             bias_mask: Masking tensor to prevent connections to future elements
             dropout: Dropout probability (Should be non-zero only during training)
+            autocast_dtype: Run projections and matmuls under torch.autocast
+                            with this dtype (e.g. torch.bfloat16), None to disable
+            quantize_kv_cache: Store the decode-time self-attention KV cache in
+                               INT8 with per-token scales, halving cache memory
+                               and bandwidth (inference only)
+            use_flash_attn: Call the flash_attn package directly when possible
+                            (requires CUDA fp16/bf16 inputs and no padding mask)
+            compile_forward: Wrap the whole forward with torch.compile to fuse
+                             projection/split/mask/softmax/merge into fewer kernels
+            num_kv_heads: Number of key/value heads for grouped-query attention
+                          (1 for multi-query). Must divide num_heads; defaults
+                          to num_heads (standard multi-head attention)
         """
         super(MultiHeadAttention, self).__init__()
         # Checks borrowed from
@@ -28,137 +117,359 @@ class MultiHeadAttention(nn.Module):
         if total_value_depth % num_heads != 0:
             raise ValueError("Value depth (%d) must be divisible by the number of "
                              "attention heads (%d)." % (total_value_depth, num_heads))
+        if num_kv_heads is None:
+            num_kv_heads = num_heads
+        if num_heads % num_kv_heads != 0:
+            raise ValueError("Number of attention heads (%d) must be divisible by the "
+                             "number of KV heads (%d)." % (num_heads, num_kv_heads))
 
         self.num_heads = num_heads
+        self.num_kv_heads = num_kv_heads
         self.query_scale = (total_key_depth//num_heads) ** -0.5
-        self.bias_mask = bias_mask
-
-        self.query_linear = nn.Linear(input_depth, total_key_depth, bias=False)
-        self.key_linear = nn.Linear(input_depth, total_key_depth, bias=False)
-        self.value_linear = nn.Linear(input_depth, total_value_depth, bias=False)
+        if bias_mask is not None:
+            # Registered as a non-persistent buffer so model.to()/.half() move
+            # and cast the mask once with the module, instead of every forward
+            try:
+                self.register_buffer('bias_mask', bias_mask, persistent=False)
+            except TypeError:
+                # torch < 1.6 has no persistent flag; registering would leak
+                # the mask into checkpoints, so keep the plain attribute there
+                self.bias_mask = bias_mask
+        else:
+            self.bias_mask = None
+
+        # Self-attention applies all three projections to the same tensor, so
+        # they are fused into a single larger GEMM (one activation read, one
+        # kernel launch). Cross-attention gets keys==values, so K and V share
+        # one fused projection while queries keep their own.
+        self.is_self_attention = attention_type in (None, 'self-attention')
+        # With grouped-query attention the K/V projections only produce
+        # num_kv_heads heads; queries always keep the full head count
+        kv_key_depth = num_kv_heads * (total_key_depth // num_heads)
+        kv_value_depth = num_kv_heads * (total_value_depth // num_heads)
+        self._qkv_split = [total_key_depth, kv_key_depth, kv_value_depth]
+        if self.is_self_attention:
+            self.qkv_linear = nn.Linear(input_depth, sum(self._qkv_split), bias=False)
+        else:
+            self.query_linear = nn.Linear(input_depth, total_key_depth, bias=False)
+            self.kv_linear = nn.Linear(input_depth, kv_key_depth + kv_value_depth, bias=False)
         self.output_linear = nn.Linear(total_value_depth, output_depth, bias=False)
 
         self.dropout = nn.Dropout(dropout)
+        self.autocast_dtype = autocast_dtype
+        self.quantize_kv_cache = quantize_kv_cache
+        self.use_flash_attn = use_flash_attn and (_flash_attn_func is not None)
 
         self.key_projected = None
         self.value_projected = None
         self.attention_type = attention_type
 
+        # Fused attention kernels never materialize the attention weights, so
+        # self.attention is only populated on the fallback path.
+        self.fast_path = _HAS_SDPA
         self.attention = None
+        self._mask_cache = {}
+        self._output_weight_cache = None
+
+        # Everything between the projections and the output GEMM is pointwise
+        # or reshaping work that torch.compile can fuse around the matmuls
+        self._forward_impl = self._forward
+        if compile_forward and hasattr(torch, 'compile'):
+            try:
+                self._forward_impl = torch.compile(self._forward, dynamic=True)
+            except RuntimeError:
+                # e.g. unsupported platform/backend; keep the eager version
+                pass
 
     def _split_heads(self, x):
+        """See the module-level (scripted) _split_heads"""
+        return _split_heads(x, self.num_heads)
+
+    def _merge_heads(self, x):
+        """See the module-level (scripted) _merge_heads"""
+        return _merge_heads(x, self.num_heads)
+
+    def _build_mask(self, query_len, key_len, dtype, device, src_masks):
         """
-        Split x such to add an extra num_heads dimension
-        Input:
-            x: a Tensor with shape [batch_size, seq_length, depth]
-        Returns:
-            A Tensor with shape [batch_size, num_heads, seq_length, depth/num_heads]
+        Combine src_masks and the sliced bias mask into one additive attention
+        mask. The sliced + cast bias mask is cached per
+        (query_len, key_len, dtype, device), so repeated forwards skip the
+        slice and cast kernels and at most one mask add remains.
         """
+        cache_key = (query_len, key_len, dtype, device)
+        bias_mask = self._mask_cache.get(cache_key)
+        if bias_mask is None:
+            bias_mask = self.bias_mask[:, :, :query_len, :key_len]
+            if (bias_mask.dtype != dtype) or (bias_mask.device != device):
+                # only hit when the inputs diverge from the module's own
+                # dtype/device (the buffer moves with the module)
+                bias_mask = bias_mask.to(dtype=dtype, device=device)
+            self._mask_cache[cache_key] = bias_mask
+
+        if src_masks is None:
+            return bias_mask
+        return src_masks + bias_mask
+
+    def _output_weight_t(self):
+        """
+        Pre-transposed, contiguous copy of the output projection weight for
+        the inference hot path, so the repeated decode-step matmuls hit the
+        plain-GEMM fast path instead of re-deriving the transposed layout
+        every call. Invalidated via the tensor version counter if the weight
+        is mutated (e.g. a checkpoint load).
+        """
+        weight = self.output_linear.weight
+        cached = self._output_weight_cache
+        if (cached is None) or (cached[0] is not weight) or (cached[1] != weight._version):
+            cached = (weight, weight._version, weight.t().contiguous())
+            self._output_weight_cache = cached
+        return cached[2]
+
+    @staticmethod
+    def _quantize_kv(x):
+        """
+        Symmetric per-token INT8 quantization over the head dim; returns the
+        quantized tensor and the per-token scales to dequantize it
+        """
+        scales = x.abs().max(dim=-1, keepdim=True)[0].clamp_(min=1e-8) / 127.0
+        return torch.round(x / scales).to(torch.int8), scales
 
-        if len(x.shape) != 3:
-            raise ValueError("x must have rank 3")
-        shape = x.shape
-        return x.view(shape[0], shape[1], self.num_heads, shape[2]//self.num_heads).permute(0, 2, 1, 3)
-
-    def _merge_heads(self, x):
+    def _cache_append(self, layer_cache, name, x):
         """
-        Merge the extra num_heads into the last dimension
+        Append x ([batch, steps, heads, head_dim]) to the pre-allocated cache
+        buffer under `name` and return a view of the valid prefix. New steps
+        are written into spare capacity (doubled when exhausted) instead of
+        re-allocating and copying the whole cache with torch.cat every step.
+        The valid length is tracked separately since the buffer is oversized.
+        """
+        length_key = name + "_len"
+        buffer = layer_cache.get(name)
+        length = layer_cache.get(length_key) or 0
+        new_length = length + x.shape[1]
+
+        if (buffer is None) or (new_length > buffer.shape[1]):
+            capacity = max(_KV_CACHE_INIT_CAPACITY, 2 * new_length)
+            grown = x.new_zeros((x.shape[0], capacity) + x.shape[2:])
+            if buffer is not None:
+                grown[:, :length] = buffer[:, :length]
+            buffer = grown
+
+        buffer[:, length:new_length] = x
+        layer_cache[name] = buffer
+        layer_cache[length_key] = new_length
+        return buffer[:, :new_length]
+
+    def from_unfused(self, state_dict, prefix=''):
+        """
+        Convert (in-place) a state_dict saved with the old separate
+        query/key/value projections to the fused layout, by concatenating the
+        old projection weights along the output dimension.
         Input:
-            x: a Tensor with shape [batch_size, num_heads, seq_length, depth/num_heads]
+            state_dict: a state_dict containing old-style projection weights
+            prefix: key prefix of this module inside state_dict
         Returns:
-            A Tensor with shape [batch_size, seq_length, depth]
+            The converted state_dict
         """
-        if len(x.shape) != 4:
-            raise ValueError("x must have rank 4")
-        shape = x.shape
-        return x.permute(0, 2, 1, 3).contiguous().view(shape[0], shape[2], shape[3]*self.num_heads)
+        query_weight = state_dict.pop(prefix + 'query_linear.weight')
+        key_weight = state_dict.pop(prefix + 'key_linear.weight')
+        value_weight = state_dict.pop(prefix + 'value_linear.weight')
+        if self.is_self_attention:
+            state_dict[prefix + 'qkv_linear.weight'] = torch.cat(
+                (query_weight, key_weight, value_weight), dim=0)
+        else:
+            state_dict[prefix + 'query_linear.weight'] = query_weight
+            state_dict[prefix + 'kv_linear.weight'] = torch.cat(
+                (key_weight, value_weight), dim=0)
+        return state_dict
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the fused projections carry separate
+        # query/key/value weights; fuse them on the fly so every existing
+        # load_state_dict(..., strict=True) call path keeps working
+        if prefix + 'key_linear.weight' in state_dict:
+            self.from_unfused(state_dict, prefix)
+        super(MultiHeadAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, queries, keys, values, src_masks=None, layer_cache=None):
+        with _autocast(queries.device.type, self.autocast_dtype):
+            return self._forward_impl(queries, keys, values, src_masks, layer_cache)
 
-        queries = self.query_linear(queries)
-        queries = self._split_heads(queries) # [batch_size, num_heads, seq_length, depth/num_heads]
-
-        if (layer_cache is not None):
-            # for inference
-            if self.attention_type == 'self-attention':
-
-                keys = self.key_linear(keys)
-                values = self.value_linear(values)
-
-                keys = self._split_heads(keys)
-                values = self._split_heads(values)
-
-                device = keys.device
-                if layer_cache["self_keys"] is not None:
-                    keys = torch.cat(
-                        (layer_cache["self_keys"].to(device), keys),
-                        dim=2)
-                if layer_cache["self_values"] is not None:
-                    values = torch.cat(
-                        (layer_cache["self_values"].to(device), values),
-                        dim=2)
-                layer_cache["self_keys"] = keys
-                layer_cache["self_values"] = values
-
-            elif self.attention_type == 'word-attention':
-                # for word-level or turn-level attention (in these cases, keys and values are already processed in encoder)
-                if layer_cache["word_keys"] is None:
-                    keys, values = self.key_linear(keys), \
-                                   self.value_linear(values)
-
-                    keys, values = self._split_heads(keys), \
-                                   self._split_heads(values)
+    def _forward(self, queries, keys, values, src_masks=None, layer_cache=None):
 
+        if self.is_self_attention:
+            if (queries is keys) and (keys is values):
+                # One fused GEMM for Q, K and V on the shared input
+                queries, keys, values = self.qkv_linear(queries).split(self._qkv_split, dim=-1)
+            else:
+                query_weight, key_weight, value_weight = self.qkv_linear.weight.split(self._qkv_split, dim=0)
+                queries = nn.functional.linear(queries, query_weight)
+                keys = nn.functional.linear(keys, key_weight)
+                values = nn.functional.linear(values, value_weight)
+
+            queries = self._split_heads(queries) # [batch_size, num_heads, seq_length, depth/num_heads]
+
+            if layer_cache is not None:
+                # for inference. The cache keeps K/V in [batch_size, seq_length,
+                # num_heads, depth/num_heads]: the projection output reshapes
+                # into that layout for free, so appending a decode step is a
+                # plain cat along the sequence dim with no permute/contiguous
+                # copy. Attention consumes a transpose view, which the batched
+                # GEMMs and SDPA handle without materializing it.
+                shape = keys.shape
+                keys = keys.view(shape[0], shape[1], self.num_kv_heads, shape[2] // self.num_kv_heads)
+                values = values.view(shape[0], shape[1], self.num_kv_heads, values.shape[-1] // self.num_kv_heads)
+                if self.quantize_kv_cache:
+                    # The cache holds INT8 K/V plus per-token scales; only the
+                    # current attention window is dequantized back, so cache
+                    # storage, appends and beam reordering move half the bytes
+                    key_quantized, key_scales = self._quantize_kv(keys)
+                    value_quantized, value_scales = self._quantize_kv(values)
+                    keys = self._cache_append(layer_cache, "self_keys", key_quantized)
+                    key_scales = self._cache_append(layer_cache, "self_keys_scale", key_scales)
+                    values = self._cache_append(layer_cache, "self_values", value_quantized)
+                    value_scales = self._cache_append(layer_cache, "self_values_scale", value_scales)
+                    keys = keys.type_as(queries) * key_scales
+                    values = values.type_as(queries) * value_scales
                 else:
-                    keys, values = layer_cache["word_keys"], \
-                                 layer_cache["word_values"]
-                layer_cache["word_keys"] = keys
-                layer_cache["word_values"] = values
+                    keys = self._cache_append(layer_cache, "self_keys", keys)
+                    values = self._cache_append(layer_cache, "self_values", values)
 
+                keys = keys.transpose(1, 2)
+                values = values.transpose(1, 2)
             else:
-                if layer_cache["turn_keys"] is None:
-                    keys, values = self.key_linear(keys), \
-                                   self.value_linear(values)
-
-                    keys, values = self._split_heads(keys), \
-                                   self._split_heads(values)
+                keys = _split_heads(keys, self.num_kv_heads)
+                values = _split_heads(values, self.num_kv_heads)
 
+        else:
+            queries = self.query_linear(queries)
+            queries = self._split_heads(queries) # [batch_size, num_heads, seq_length, depth/num_heads]
+
+            cache_prefix = 'word' if self.attention_type == 'word-attention' else 'turn'
+            if (layer_cache is not None) and (layer_cache[cache_prefix + "_keys"] is not None):
+                # keys and values are already processed in encoder, reuse the cached projections
+                keys = layer_cache[cache_prefix + "_keys"]
+                values = layer_cache[cache_prefix + "_values"]
+            else:
+                if keys is values:
+                    # One fused GEMM for K and V on the shared encoder outputs
+                    keys, values = self.kv_linear(keys).split(self._qkv_split[1:], dim=-1)
                 else:
-                    keys, values = layer_cache["turn_keys"], \
-                                 layer_cache["turn_values"]
-                layer_cache["turn_keys"] = keys
-                layer_cache["turn_values"] = values
-
+                    key_weight, value_weight = self.kv_linear.weight.split(self._qkv_split[1:], dim=0)
+                    keys = nn.functional.linear(keys, key_weight)
+                    values = nn.functional.linear(values, value_weight)
+                keys = _split_heads(keys, self.num_kv_heads)
+                values = _split_heads(values, self.num_kv_heads)
+
+            if layer_cache is not None:
+                # Cached K/V are re-read every decode step, so pay for a
+                # packed [batch, heads, seq, head_dim] copy once instead of
+                # strided reads (or per-step gather copies) on the permuted
+                # projection view for the rest of the generation
+                layer_cache[cache_prefix + "_keys"] = keys = keys.contiguous()
+                layer_cache[cache_prefix + "_values"] = values = values.contiguous()
+
+        if self.num_kv_heads != self.num_heads:
+            # Grouped-query attention: projections, cache traffic and beam
+            # reordering all ran with num_kv_heads heads; broadcast the shared
+            # KV heads across their query-head group only for the matmuls
+            group_size = self.num_heads // self.num_kv_heads
+            keys = keys.repeat_interleave(group_size, dim=1)
+            values = values.repeat_interleave(group_size, dim=1)
+
+        if self.training:
+            # Inspection-only side effects; during inference they would pin
+            # the full projected K/V (and grow with the cache) across steps
+            self.key_projected = keys
+            self.value_projected = values
+
+        # Combine the padding and triangular masks into one additive mask
+        attn_mask = src_masks
+        is_causal = False
+        use_flash = self.use_flash_attn and queries.is_cuda \
+            and queries.dtype in (torch.float16, torch.bfloat16)
+        if (self.bias_mask is not None) and (layer_cache is None):
+            if (self.fast_path or use_flash) and (src_masks is None) and (queries.shape[2] == keys.shape[2]):
+                # Pure causal masking: skip building a mask entirely and use
+                # the kernel's internal causal path
+                is_causal = True
+            else:
+                attn_mask = self._build_mask(queries.shape[2], keys.shape[2],
+                                             queries.dtype, queries.device, src_masks)
+
+        if use_flash and (attn_mask is None):
+            # flash_attn takes [batch, seq, heads, head_dim]; the transposes
+            # are stride-only views
+            contexts = _flash_attn_func(
+                queries.transpose(1, 2), keys.transpose(1, 2), values.transpose(1, 2),
+                dropout_p=self.dropout.p if self.training else 0.0,
+                causal=is_causal).transpose(1, 2)
+        elif self.fast_path:
+            # The fused kernel handles scale/mask/softmax/dropout. SDPA's
+            # default scale is 1/sqrt(head_dim), identical to self.query_scale.
+            contexts = nn.functional.scaled_dot_product_attention(
+                queries, keys, values,
+                attn_mask=attn_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+                is_causal=is_causal)
         else:
-            keys = self.key_linear(keys)
-            values = self.value_linear(values)
-            keys = self._split_heads(keys)
-            values = self._split_heads(values)
-
-        self.key_projected = keys
-        self.value_projected = values
-
-        # scale queries
-        queries *= self.query_scale
-
-        logits = torch.matmul(queries, keys.permute(0, 1, 3, 2)) # (batch_size, num_heads, queries_seq_len, keys_seq_len)
-
-        if src_masks is not None:
-            # Encoder Self-Attention
-            logits += src_masks
+            # scale queries (out-of-place: queries may be a view into the
+            # fused QKV projection output, which K/V still alias)
+            queries = queries * self.query_scale
+
+            batch_size, _, query_len, head_dim = queries.shape
+            key_len = keys.shape[2]
+
+            if (query_len == 1) and (attn_mask is None):
+                # Single-query decode step: both matmuls are matrix-vector
+                # products, so run them directly on the 4D tensors. That
+                # consumes the KV cache's transpose view via strides and skips
+                # flattening (i.e. copying) the whole cache to [B*H, L, D/H]
+                # every generated token. The size-1 query dim also makes the
+                # later head merge a free reshape.
+                logits = torch.matmul(queries, keys.transpose(-2, -1))
+                weights = nn.functional.softmax(logits.float(), dim=-1).type_as(values)
+                if self.training and self.dropout.p > 0:
+                    weights = nn.functional.dropout(weights, p=self.dropout.p, training=True)
+                contexts = torch.matmul(weights, values)
+            else:
+                # Flatten batch and heads so both matmuls run as one large
+                # batched GEMM of B*H problems instead of nested batching
+                queries_3d = queries.reshape(batch_size * self.num_heads, query_len, head_dim)
+                keys_3d = keys.reshape(batch_size * self.num_heads, key_len, head_dim)
+                values_3d = values.reshape(batch_size * self.num_heads, key_len, -1)
+
+                if attn_mask is not None:
+                    # Fuse the mask addition into the GEMM epilogue with baddbmm
+                    logits = torch.baddbmm(
+                        attn_mask.expand(batch_size, self.num_heads, query_len, key_len)
+                                 .reshape(batch_size * self.num_heads, query_len, key_len),
+                        queries_3d, keys_3d.transpose(1, 2))
+                else:
+                    # transpose(1, 2) is dispatched as a transposed-B GEMM,
+                    # no physical transpose of the keys is materialized
+                    logits = torch.bmm(queries_3d, keys_3d.transpose(1, 2)) # (batch_size * num_heads, queries_seq_len, keys_seq_len)
 
-        # Add bias to mask future values (Triangular Masking)
-        if (self.bias_mask is not None) and (layer_cache is None):
-            logits += self.bias_mask[:, :, :logits.shape[-2], :logits.shape[-1]].type_as(logits.data)
+                # Keep the softmax in FP32 for numerical stability under
+                # reduced-precision autocast, then cast back for the PV matmul
+                weights = nn.functional.softmax(logits.float(), dim=-1).type_as(values)
 
-        weights = nn.functional.softmax(logits, dim=-1)
+                if self.training:
+                    self.attention = weights.view(batch_size, self.num_heads, query_len, key_len)
 
-        weights = self.dropout(weights)
+                # Only dispatch dropout when it can actually do something;
+                # at eval (or p == 0) the module call is a pure no-op that
+                # still costs a Python dispatch per layer per step
+                if self.training and self.dropout.p > 0:
+                    weights = nn.functional.dropout(weights, p=self.dropout.p, training=True)
 
-        contexts = torch.matmul(weights, values)
+                contexts = torch.bmm(weights, values_3d).view(batch_size, self.num_heads, query_len, -1)
         # Merge Heads
         contexts = self._merge_heads(contexts)
-        outputs = self.output_linear(contexts)
+
+        if self.training:
+            outputs = self.output_linear(contexts)
+        else:
+            outputs = torch.matmul(contexts, self._output_weight_t())
         return outputs
 
 
@@ -179,11 +490,17 @@ class Conv(nn.Module):
         """
         super(Conv, self).__init__()
         padding = (kernel_size - 1, 0) if pad_type == 'left' else (kernel_size // 2, (kernel_size - 1) // 2)
-        self.pad = nn.ConstantPad1d(padding, 0)
-        self.conv = nn.Conv1d(input_size, output_size, kernel_size=kernel_size, padding=0)
+        # Symmetric padding is folded into the conv kernel itself, so the
+        # padded copy of the input is only materialized for the asymmetric
+        # (causal) case
+        self.padding = padding if padding[0] != padding[1] else None
+        self.conv = nn.Conv1d(input_size, output_size, kernel_size=kernel_size,
+                              padding=padding[0] if self.padding is None else 0)
 
     def forward(self, inputs):
-        inputs = self.pad(inputs.permute(0, 2, 1))
+        inputs = inputs.permute(0, 2, 1)
+        if self.padding is not None:
+            inputs = nn.functional.pad(inputs, self.padding)
         outputs = self.conv(inputs).permute(0, 2, 1)
 
         return outputs
@@ -194,7 +511,8 @@ class PositionwiseFeedForward(nn.Module):
     Does a Linear + RELU + Linear on each of the timesteps
     """
 
-    def __init__(self, input_depth, filter_size, output_depth, layer_config='ll', padding='left', dropout=0.0):
+    def __init__(self, input_depth, filter_size, output_depth, layer_config='ll', padding='left', dropout=0.0,
+                 autocast_dtype=None):
         """
         Parameters:
             input_depth: Size of last dimension of input
@@ -205,32 +523,48 @@ class PositionwiseFeedForward(nn.Module):
             padding: left -> pad on the left side (to mask future data),
                      both -> pad on both sides
             dropout: Dropout probability (Should be non-zero only during training)
+            autocast_dtype: Run the layers under torch.autocast with this
+                            dtype (e.g. torch.bfloat16), None to disable
         """
         super(PositionwiseFeedForward, self).__init__()
 
-        layers = []
+        modules = OrderedDict()
         sizes = ([(input_depth, filter_size)] +
                  [(filter_size, filter_size)] * (len(layer_config) - 2) +
                  [(filter_size, output_depth)])
 
-        for lc, s in zip(list(layer_config), sizes):
+        for i, (lc, s) in enumerate(zip(list(layer_config), sizes)):
             if lc == 'l':
-                layers.append(nn.Linear(*s))
+                modules[str(i)] = nn.Linear(*s)
             elif lc == 'c':
-                layers.append(Conv(*s, kernel_size=3, pad_type=padding))
+                modules[str(i)] = Conv(*s, kernel_size=3, pad_type=padding)
             else:
                 raise ValueError("Unknown layer type {}".format(lc))
-
-        self.layers = nn.ModuleList(layers)
-        self.relu = nn.ReLU()
-        self.dropout = nn.Dropout(dropout)
+            if i < len(layer_config) - 1:
+                # parameterless, so these names never reach the state_dict
+                modules['relu{}'.format(i)] = nn.ReLU()
+                modules['dropout{}'.format(i)] = nn.Dropout(dropout)
+
+        # One nn.Sequential runs the whole stack from C++ instead of a
+        # Python-level loop with per-layer bookkeeping. The Linear/Conv
+        # modules keep their old numeric names, so checkpoints still load.
+        self.layers = nn.Sequential(modules)
+        self.autocast_dtype = autocast_dtype
+
+        # A pure-Linear stack has no data-dependent control flow, so
+        # torch.compile can fuse the linear/ReLU/dropout chain into fewer
+        # kernels. Conv stacks stay eager.
+        self._run_layers = self._feed_forward
+        if set(layer_config) == {'l'} and hasattr(torch, 'compile'):
+            try:
+                self._run_layers = torch.compile(self._feed_forward, dynamic=True)
+            except RuntimeError:
+                # e.g. unsupported platform/backend; keep the eager version
+                pass
+
+    def _feed_forward(self, x):
+        return self.layers(x)
 
     def forward(self, inputs):
-        x = inputs
-        for i, layer in enumerate(self.layers):
-            x = layer(x)
-            if i < len(self.layers):
-                x = self.relu(x)
-                x = self.dropout(x)
-
-        return x
+        with _autocast(inputs.device.type, self.autocast_dtype):
+            return self._run_layers(inputs)